@@ -8,36 +8,67 @@ import re
 
 from liger_kernel.transformers import AutoLigerKernelForCausalLM
 from torch.optim import AdamW
-from transformers import AutoTokenizer, AutoConfig
+from transformers import AutoTokenizer, AutoConfig, BitsAndBytesConfig
 from trl import SFTConfig, SFTTrainer, DPOConfig, DPOTrainer
-from peft import LoraConfig, get_peft_model, PeftModel
+from peft import LoraConfig, get_peft_model, PeftModel, prepare_model_for_kbit_training
 
 
 logger = logging.getLogger(__name__)
 
+# attention-only LoRA: roughly a third of the adapter FLOPs of the full set, usually enough for instruction tuning
+ATTENTION_TARGET_MODULES = ["q_proj", "k_proj", "v_proj", "o_proj"]
+# more tokenizer processes than this only add fork and IPC overhead
+MAX_DATASET_NUM_PROC = 16
+
+
+def available_cpu_count():
+    # respects affinity and cpuset limits of containers and shared nodes, unlike os.cpu_count()
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
 
 class Tuningtron:
     def __init__(self,
                  base_model_id,
                  enable_deepspeed=True,
-                 enable_offload_optimizer=True,
+                 enable_offload_optimizer=None,
+                 zero_stage=3,
+                 enable_4bit=False,
+                 enable_torch_compile=False,
                  target_modules=["q_proj", "k_proj", "v_proj", "o_proj", "gate_proj", "up_proj", "down_proj", "lm_head"]):
+        if enable_4bit and enable_deepspeed:
+            raise ValueError("4-bit quantization is not supported together with deepspeed, pass enable_deepspeed=False")
+        if zero_stage not in (2, 3):
+            raise ValueError(f"Unsupported zero stage: {zero_stage}")
+
         self.base_model_id = base_model_id
         self.model_config = AutoConfig.from_pretrained(base_model_id)
         self.tokenizer = AutoTokenizer.from_pretrained(base_model_id)
         self.target_modules = target_modules
         self.device_map = "auto"
         self.deepspeed = None
-        self.attn_implementation = "flash_attention_2"
+        self.attn_implementation = "flash_attention_2" if torch.cuda.is_available() else "sdpa"
         self.dtype = torch.bfloat16
+        self.load_in_4bit = enable_4bit
 
         self.show_cuda_info()
         self.show_tokenizer_info()
 
+        # compile wraps flash attention and liger kernels instead of replacing them; not used with deepspeed
+        self.torch_compile = enable_torch_compile and torch.cuda.is_available() and not enable_deepspeed
+        if enable_torch_compile and not self.torch_compile:
+            logger.warning("torch compile requested but disabled: it requires a GPU and enable_deepspeed=False")
+        logger.info(f"torch compile: {self.torch_compile}")
+
         if enable_deepspeed:
             self.device_map = None
-            self.deepspeed = self.get_deepspeed_config(enable_offload_optimizer)
-            logger.info("deepspeed: enabled")
+            # stage 2 is meant for models that fit in GPU memory, so keep the optimizer on GPU unless asked otherwise
+            if enable_offload_optimizer is None:
+                enable_offload_optimizer = zero_stage == 3
+            self.deepspeed = self.get_deepspeed_config(enable_offload_optimizer, zero_stage)
+            logger.info(f"deepspeed: enabled, zero stage: {zero_stage}, offload optimizer: {enable_offload_optimizer}")
 
     def create_optimizer(self, model, learning_rate):
         LM_HEAD_RE = re.compile(r"(?:^|\.)(lm_head)(?:\.|$)")
@@ -47,11 +78,12 @@ class Tuningtron:
             if p.requires_grad and "lora_" in name:
                 (head_params if LM_HEAD_RE.search(name) else other_params).append(p)
 
-        return AdamW(
-            [
-                {"params": other_params, "lr": learning_rate, "weight_decay": 0.01},
-                {"params": head_params,  "lr": min(2e-5, learning_rate/3), "weight_decay": 0.01}  # lm_head — меньший LR
-            ], betas=(0.9, 0.95), eps=1e-8)
+        param_groups = [{"params": other_params, "lr": learning_rate, "weight_decay": 0.01}]
+        # lm_head is not a target with full_lora=False, and deepspeed zero 2 cannot flatten an empty group
+        if head_params:
+            param_groups.append({"params": head_params, "lr": min(2e-5, learning_rate/3), "weight_decay": 0.01})  # lm_head — меньший LR
+
+        return AdamW(param_groups, betas=(0.9, 0.95), eps=1e-8)
 
     def sft(self,
             dataset,
@@ -63,7 +95,10 @@ class Tuningtron:
             backpropagation_batch_size=1,
             gradient_accum_steps=1,
             learning_rate=1e-5,
-            warmup_ratio=0.1):
+            warmup_ratio=0.1,
+            gradient_checkpointing=True,
+            full_lora=True,
+            background_collation=True):
         dataset = datasets.load_dataset(dataset, split="train")
         train_dataset, eval_dataset = self.prepare_datasets(dataset, do_eval)
 
@@ -73,13 +108,13 @@ class Tuningtron:
         logger.info("Dataset example row after tokenize:")
         logger.info(self.tokenizer.apply_chat_template(train_dataset["messages"][0], tokenize=True, add_generation_prompt=False))
 
-        args = SFTConfig(**self.prepare_args(num_train_epochs, warmup_ratio, backpropagation_batch_size, gradient_accum_steps))
+        args = SFTConfig(**self.prepare_args(num_train_epochs, warmup_ratio, backpropagation_batch_size, gradient_accum_steps, gradient_checkpointing, background_collation))
         args.assistant_only_loss = True
         args.use_liger_kernel = True
         logger.info(str(args))
 
-        base_model = self.load_base_model()
-        cfg = self.get_lora_config(lora_rank, lora_alpha)
+        base_model = self.load_base_model(gradient_checkpointing)
+        cfg = self.get_lora_config(lora_rank, lora_alpha, full_lora)
         peft_model = get_peft_model(base_model, cfg)
         logger.info(str(peft_model.get_model_status()))
 
@@ -104,7 +139,10 @@ class Tuningtron:
             backpropagation_batch_size=1,
             gradient_accum_steps=1,
             learning_rate=1e-5,
-            warmup_ratio=0.1):
+            warmup_ratio=0.1,
+            gradient_checkpointing=True,
+            full_lora=True,
+            background_collation=True):
         dataset = datasets.load_dataset(dataset, split="train")
         train_dataset, eval_dataset = self.prepare_datasets(dataset, do_eval)
 
@@ -120,7 +158,7 @@ class Tuningtron:
         logger.info("Rejected ------>")
         logger.info(self.tokenizer.apply_chat_template(train_dataset["rejected"][0], tokenize=True, add_generation_prompt=False))
 
-        args = DPOConfig(**self.prepare_args(num_train_epochs, warmup_ratio, backpropagation_batch_size, gradient_accum_steps))
+        args = DPOConfig(**self.prepare_args(num_train_epochs, warmup_ratio, backpropagation_batch_size, gradient_accum_steps, gradient_checkpointing, background_collation))
         args.optimize_device_cache = True
         args.use_liger_loss = True
         args.use_num_logits_to_keep = True
@@ -128,8 +166,8 @@ class Tuningtron:
         args.max_completion_length = None
         logger.info(args)
 
-        base_model = self.load_base_model()
-        cfg = self.get_lora_config(lora_rank, lora_alpha)
+        base_model = self.load_base_model(gradient_checkpointing)
+        cfg = self.get_lora_config(lora_rank, lora_alpha, full_lora)
         peft_model = get_peft_model(base_model, cfg)
         logger.info(peft_model.get_model_status())
 
@@ -150,7 +188,8 @@ class Tuningtron:
         self.eval_steps = None
 
         if do_eval:
-            dataset = dataset.train_test_split(test_size=0.1)
+            # fixed seed keeps split fingerprints stable, so the trainer's tokenization map is reused from the datasets cache on re-runs
+            dataset = dataset.train_test_split(test_size=0.1, seed=42)
             train_dataset = dataset["train"]
             eval_dataset = dataset["test"]
             self.eval_strategy = "steps"
@@ -164,14 +203,19 @@ class Tuningtron:
 
         return train_dataset, eval_dataset
 
-    def prepare_args(self, num_train_epochs, warmup_ratio, batch_size, gradient_accum_steps):
+    def prepare_args(self, num_train_epochs, warmup_ratio, batch_size, gradient_accum_steps, gradient_checkpointing=True, background_collation=True):
+        dataloader_num_workers = 0
+        if background_collation:
+            # every rank started by the deepspeed launcher gets its own workers, so share the cores between them
+            local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+            dataloader_num_workers = min(8, available_cpu_count() // (2 * local_world_size))
         return {
             "output_dir": ".",
             "num_train_epochs": num_train_epochs,
             "logging_steps": 1,
             "eval_strategy": self.eval_strategy,
             "eval_steps": self.eval_steps,
-            "gradient_checkpointing": True,
+            "gradient_checkpointing": gradient_checkpointing,  # saves VRAM at the cost of recomputing activations on backward
             "gradient_checkpointing_kwargs": {"use_reentrant": False},
             "save_strategy": "no",
             "bf16": True,
@@ -180,13 +224,23 @@ class Tuningtron:
             "per_device_eval_batch_size": batch_size,
             "gradient_accumulation_steps": gradient_accum_steps,
             "eval_accumulation_steps": 1,
-            "padding_free": True,
+            "padding_free": self.attn_implementation.startswith("flash_attention"),  # packing is only masked correctly with flash attention
             "max_length": None,
+            "dataset_num_proc": min(MAX_DATASET_NUM_PROC, available_cpu_count()),  # tokenizer parallelism is disabled above, so parallelize the dataset map by processes
+            "dataloader_num_workers": dataloader_num_workers,
+            "dataloader_persistent_workers": dataloader_num_workers > 0,  # otherwise workers are re-forked for every eval loop
+            "torch_compile": self.torch_compile,
             "deepspeed": self.deepspeed
         }
 
-    def get_lora_config(self, rank, lora_alpha):
+    def get_lora_config(self, rank, lora_alpha, full_lora=True):
         lora_alpha = lora_alpha if lora_alpha else rank
+        target_modules = self.target_modules
+        if not full_lora:
+            # a string such as "all-linear" is a peft shortcut, not a list of module names
+            target_modules = [] if isinstance(target_modules, str) else [m for m in target_modules if m in ATTENTION_TARGET_MODULES]
+            if not target_modules:
+                raise ValueError(f"full_lora=False requires target_modules to include some of {ATTENTION_TARGET_MODULES}, got: {self.target_modules}")
 
         pat_string = r".*lm_head"
         pat = re.compile(pat_string)
@@ -197,7 +251,7 @@ class Tuningtron:
                             lora_alpha=lora_alpha,
                             rank_pattern={pat_string: max(1, rank // 4)},  # для экономии памяти, т.к. для lm_head не требуются большие матрицы
                             alpha_pattern={pat_string: max(1, (lora_alpha or rank) // 4)},  # для экономии памяти, т.к. для lm_head не требуются большие матрицы
-                            target_modules=self.target_modules,
+                            target_modules=target_modules,
                             task_type="CAUSAL_LM")
         logger.info("Lora config:" + str(config))
         return config
@@ -221,38 +275,64 @@ class Tuningtron:
         logger.info("Padding size: " + self.tokenizer.padding_side)
 
     def merge(self, merged_name, first_adapter):
-        base_model = self.load_base_model(False)
+        # adapters are always merged into the full precision weights
+        base_model = self.load_base_model(False, load_in_4bit=False)
 
         peft_model = PeftModel.from_pretrained(base_model, first_adapter, torch_dtype=torch.bfloat16)
         logger.info(f"Merging adapter: {first_adapter} -> {merged_name}")
         merged_model = peft_model.merge_and_unload()
         merged_model.save_pretrained(merged_name)
-        # get original tokenizer for save
-        tmp_tokenizer = AutoTokenizer.from_pretrained(self.base_model_id)
-        tmp_tokenizer.save_pretrained(merged_name)
+        # self.tokenizer is the unmodified original tokenizer, no need to reload it
+        self.tokenizer.save_pretrained(merged_name)
         try:
-            tmp_tokenizer.save_vocabulary(merged_name)
+            self.tokenizer.save_vocabulary(merged_name)
         except:
             pass
 
-    def load_base_model(self, gradient_checkpointing=True):
+    def load_base_model(self, gradient_checkpointing=True, load_in_4bit=None):
+        load_in_4bit = self.load_in_4bit if load_in_4bit is None else load_in_4bit
+        quantization_config = None
+        if load_in_4bit:
+            quantization_config = BitsAndBytesConfig(load_in_4bit=True,
+                                                     bnb_4bit_quant_type="nf4",
+                                                     bnb_4bit_compute_dtype=self.dtype,
+                                                     bnb_4bit_use_double_quant=True)
+
         self.base_model = AutoLigerKernelForCausalLM.from_pretrained(self.base_model_id,
                                                                      torch_dtype=self.dtype,
                                                                      attn_implementation=self.attn_implementation,
+                                                                     quantization_config=quantization_config,
                                                                      device_map=self.device_map)
         logger.info(self.base_model)
 
+        if load_in_4bit:
+            # checkpointing is configured below for both paths
+            self.base_model = prepare_model_for_kbit_training(self.base_model, use_gradient_checkpointing=False)
+            # peft upcasts every non-quantized weight to fp32, with a 256k vocab that is several GB for embeddings and lm_head;
+            # the small norm weights are left in fp32
+            for module in (self.base_model.get_input_embeddings(), self.base_model.get_output_embeddings()):
+                if module is not None:
+                    module.to(self.dtype)
+
         if gradient_checkpointing:
-            self.base_model.gradient_checkpointing_enable()
+            self.base_model.gradient_checkpointing_enable(gradient_checkpointing_kwargs={"use_reentrant": False})
         else:
             self.base_model.gradient_checkpointing_disable()
         return self.base_model
 
-    def get_deepspeed_config(self, enable_offload_optimizer=True):
-        cfg = {
-            "zero_force_ds_cpu_optimizer": False,
-            "bf16": {"enabled": "auto"},
-            "zero_optimization": {
+    def get_deepspeed_config(self, enable_offload_optimizer=True, zero_stage=3):
+        if zero_stage == 2:
+            # model weights fit in GPU memory: partition optimizer states and gradients only, no param offload traffic
+            zero_optimization = {
+                "stage": 2,
+                "allgather_partitions": True,
+                "overlap_comm": True,
+                "reduce_scatter": True,
+                "reduce_bucket_size": "auto",
+                "contiguous_gradients": True
+            }
+        elif zero_stage == 3:
+            zero_optimization = {
                 "stage": 3,
                 "offload_param": {"device": "cpu"},
                 "overlap_comm": True,
@@ -264,7 +344,14 @@ class Tuningtron:
                 "prefetch_bucket_size": "auto",
                 "param_persistence_threshold": "auto",
                 "gather_16bit_weights_on_model_save": True
-            },
+            }
+        else:
+            raise ValueError(f"Unsupported zero stage: {zero_stage}")
+
+        cfg = {
+            "zero_force_ds_cpu_optimizer": False,
+            "bf16": {"enabled": "auto"},
+            "zero_optimization": zero_optimization,
             "gradient_accumulation_steps": "auto",
             "gradient_clipping": "auto",
             "train_batch_size": "auto",